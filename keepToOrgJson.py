@@ -1,13 +1,21 @@
 #!/usr/bin/env python3
 
 import os
-from os.path import exists
 import html
+import io
+import re
 import sys
-import datetime
-import json
+import time
 import argparse
-from shutil import copy2
+from pathlib import Path
+from collections import defaultdict
+
+try:
+    import orjson as json
+except ImportError:
+    import json
+from shutil import copyfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 """
 KeepToOrg.py
@@ -28,69 +36,63 @@ based on tags. This will also format lists and try to be smart.
 # Tags have the syntax :tag: or :tag1:tag2:
 
 def tagsToOrgString(tags):
-    if len(tags) == 0:
-        return ""
+    return ":" + ":".join(tags) + ":" if tags else ""
 
-    tagString = ":"
-    for tag in tags:
-        tagString += tag + ":"
 
-    return tagString
+# Keep's list markup and what it becomes in Org; anything mapped to "" is flat out removed
+_LIST_HTML_REPLACEMENTS = {
+    '<li class="listitem"><span class="bullet">&#9744;</span>\n': "- [ ] ",
+    '<li class="listitem checked"><span class="bullet">&#9745;</span>': "- [X] ",
+    '<span class="text">': "",
+    "</span>": "",
+    "</li>": "",
+    '<ul class="list">': "",
+    "</ul>": "",
+}
+_LIST_HTML_RE = re.compile("|".join(map(re.escape, _LIST_HTML_REPLACEMENTS)))
 
 
 class Note:
     def __init__(self):
         self.title = ""
         self.body = ""
+        # Already html-unescaped, see toOrgString
         self.tags = []
         self.archived = False
         # If no date can be parsed, set it to Jan 1, 2000
-        self.date = datetime.datetime(2000, 1, 1)
+        self.timestamp = time.mktime((2000, 1, 1, 0, 0, 0, 0, 0, -1))
+        self.dateString = "[2000-01-01 Sat 00:00]"
         self.images = []
 
-    def toOrgString(self):
+    def toOrgString(self, stripTags=True):
         # status = '(archived) ' if self.archived else ''
         # Create a copy so we can mangle it
         body = self.body
         title = self.title
 
-        # Convert lists to org lists. This is a total hack but works
-        body = body.replace(
-            '<li class="listitem"><span class="bullet">&#9744;</span>\n', "- [ ] "
-        )
-        body = body.replace(
-            '<li class="listitem checked"><span class="bullet">&#9745;</span>', "- [X] "
-        )
-        # Flat out remove these
-        for htmlTagToErase in [
-            '<span class="text">',
-            "</span>",
-            "</li>",
-            '<ul class="list">',
-            "</ul>",
-        ]:
-            body = body.replace(htmlTagToErase, "")
+        # Convert lists to org lists and flat out remove the leftover markup in one pass.
+        # This is a total hack but works
+        body = _LIST_HTML_RE.sub(lambda match: _LIST_HTML_REPLACEMENTS[match.group(0)], body)
         # This is very weird, but fix the edge case where the list entry has a new line before the content
         for listTypeToFixNewLines in ["- [ ] \n", "- [X] \n"]:
             body = body.replace(listTypeToFixNewLines, listTypeToFixNewLines[:-1])
 
         # Unescape all (e.g. remove &quot and replace with ")
-        title = html.unescape(title)
-        body = html.unescape(body)
-        for i, tag in enumerate(self.tags):
-            self.tags[i] = html.unescape(tag)
+        # Tags are expected to be unescaped already when they are assigned to the note
+        _unesc = html.unescape
+        title = _unesc(title)
+        body = _unesc(body)
 
         # Strip tags
-        for tag in self.tags:
-            body = body.replace("#{}".format(tag), "")
+        if stripTags:
+            for tag in self.tags:
+                body = body.replace("#{}".format(tag), "")
 
-        # add image links:
-        imageLinks = ["[[file:" + place + "]]" for place in self.images]
-        
-        
         # Remove any leading/trailing whitespace (possibly leftover from tags stripping)
         body = body.strip()
-        body += ("\n".join(imageLinks))
+        # add image links:
+        if self.images:
+            body += "\n".join(f"[[file:{place}]]" for place in self.images)
 
         # Make a title if necessary
         orgTitle = title
@@ -108,9 +110,7 @@ class Note:
 
         nesting = "*" if self.archived else ""
         # Various levels of information require different formats
-        created = self.date.strftime(
-            ":PROPERTIES:\n:CREATED:  [%Y-%m-%d %a %H:%M]\n:END:"
-        )
+        created = ":PROPERTIES:\n:CREATED:  {}\n:END:".format(self.dateString)
         if body or len(self.tags):
             if body and not len(self.tags):
                 return "*{} {}\n{}\n{}".format(nesting, orgTitle, created, body)
@@ -127,15 +127,19 @@ class Note:
             return "*{} {}\n{}".format(nesting, orgTitle, created)
 
 
+# Like os.walk, but scandir's entries already carry the joined path and (on most platforms) the file type
+def _walkJsonFiles(directory):
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _walkJsonFiles(entry.path)
+            elif entry.name.endswith(".json"):
+                yield entry.path
+
+
 def getAllNoteHtmlFiles(htmlDir):
     print("Looking for notes in {}".format(htmlDir))
-    noteHtmlFiles = []
-    jsonFiles = []
-    for root, dirs, files in os.walk(htmlDir):
-        for file in files:
-            ending = ".json"
-            if file.endswith(ending):
-                jsonFiles.append(os.path.join(root, file))
+    jsonFiles = sorted(_walkJsonFiles(htmlDir))
     print("Found {} notes".format(len(jsonFiles)))
 
     return jsonFiles
@@ -148,94 +152,110 @@ def getHtmlValueIfMatches(line, tag, endTag):
     return "", False
 
 
+# Characters dropped from tags before they are used as file names
+_UNSAFE_FILENAME_CHARS = str.maketrans("", "", "/.")
+
+
 def makeSafeFilename(strToPurify):
-    strToPurify = strToPurify.replace("/", "")
-    strToPurify = strToPurify.replace(".", "")
-    return strToPurify
+    return strToPurify.translate(_UNSAFE_FILENAME_CHARS)
 
 
-def main(keepHtmlDir, outputDir, includeArchived, splitByTag):
-    jsonFiles = getAllNoteHtmlFiles(keepHtmlDir)
+def parse_one(jsonFile):
+    # Read in the file
+    jsonBytes = Path(jsonFile).read_bytes()
+    meta_data = json.loads(jsonBytes)
 
-    noteGroups = {}
+    note = Note()
 
-    for i, jsonFile in enumerate(jsonFiles):
-        # Read in the file
+    if meta_data["isArchived"] or meta_data["isTrashed"]: # Treat trashed notes as archived (maybe ignore them instead?)
+        note.archived = True
+    note.timestamp = meta_data["createdTimestampUsec"] / 1_000_000
+    note.dateString = time.strftime("[%Y-%m-%d %a %H:%M]", time.localtime(note.timestamp))
 
-        jsonFile = open(jsonFile, "r")
-        jsonString = jsonFile.read()
-        jsonFile.close()
-        meta_data = json.loads(jsonString)
+    if meta_data["title"]:
+        note.title = meta_data["title"]
+    
+    if "textContent" in meta_data:
+        note.body = meta_data["textContent"]
 
-        note = Note()
+    elif "listContent" in meta_data:
+        print(meta_data["listContent"])
+        text = "\n".join(x['text'] for x in meta_data["listContent"])
+        note.body = f"List:\n{text}"
+    else:
+        raise Exception("No textContent or listContent in note")
 
-        if meta_data["isArchived"] or meta_data["isTrashed"]: # Treat trashed notes as archived (maybe ignore them instead?)
-            note.archived = True
-        note.date = datetime.datetime.fromtimestamp(
-            meta_data["createdTimestampUsec"] / 1000000.0
-        )
+    # Attachments are copied by the caller; just remember which ones we saw
+    attachmentsToCopy = []
+    if "attachments" in meta_data:
+        for attachment in meta_data["attachments"]:
+            attachmentsToCopy.append(attachment["filePath"])
+            note.images.append(attachment["filePath"])
 
-        if meta_data["title"]:
-            note.title = meta_data["title"]
-        
-        if "textContent" in meta_data:
-            note.body = meta_data["textContent"]
+    return note, attachmentsToCopy
 
-        elif "listContent" in meta_data:
-            print(meta_data["listContent"])
-            text = "\n".join([x['text'] for x in meta_data["listContent"]])
-            note.body = f"List:\n{text}"
-        else:
-            raise Exception("No textContent or listContent in note")
-        
-        # TODO: consider copying images to target file
-        if "attachments" in meta_data:
-            for attachment in meta_data["attachments"]:
-                if exists(os.path.join(keepHtmlDir, attachment["filePath"])):
-                    copy2(os.path.join(keepHtmlDir, attachment["filePath"]),outputDir)
-                elif exists(os.path.join(keepHtmlDir, attachment["filePath"][:-3]+"jpg")):
-                    copy2(os.path.join(keepHtmlDir, attachment["filePath"][:-3]+"jpg"),outputDir) 
-                elif exists(os.path.join(keepHtmlDir, attachment["filePath"][:-3]+"jpeg")):
-                    copy2(os.path.join(keepHtmlDir, attachment["filePath"][:-3]+"jpeg"),outputDir) 
-                note.images.append(attachment["filePath"])
-        
-        if splitByTag:
+
+def main(keepHtmlDir, outputDir, includeArchived, splitByTag):
+    # Bound locally since it is called for every attachment
+    _join = os.path.join
+
+    jsonFiles = getAllNoteHtmlFiles(keepHtmlDir)
+
+    # Parsing is independent per note, so spread it over all cores
+    with ProcessPoolExecutor() as executor:
+        results = list(executor.map(parse_one, jsonFiles, chunksize=64))
+
+    # Takeout puts attachments next to the notes; list them once instead of probing for each one
+    with os.scandir(keepHtmlDir) as entries:
+        existingFiles = {entry.name: entry.path for entry in entries if entry.is_file()}
+    filesToCopy = {}
+
+    for note, attachmentsToCopy in results:
+        for filePath in attachmentsToCopy:
+            # The exported file is sometimes a .jpg/.jpeg even though the note says otherwise
+            for candidate in (filePath, filePath[:-3] + "jpg", filePath[:-3] + "jpeg"):
+                if candidate in existingFiles:
+                    filesToCopy[existingFiles[candidate]] = _join(outputDir, candidate)
+                    break
+
+    if splitByTag:
+        noteGroups = defaultdict(list)
+        for note, _ in results:
             for tag in note.tags: 
-                if tag in noteGroups:
-                    noteGroups[tag].append(note)
-                else:
-                    noteGroups[tag] = [note]
+                noteGroups[tag].append(note)
 
-        if not note.tags:
-            if "Untagged" in noteGroups:
+            if not note.tags:
                 noteGroups["Untagged"].append(note)
-            else:
-                noteGroups["Untagged"] = [note]
+    else:
+        # Everything goes into a single file, so there is no need to look at tags at all
+        allNotes = [note for note, _ in results]
+        noteGroups = {"Untagged": allNotes} if allNotes else {}
 
+    # Copying is I/O bound, so overlap it; copyfile lets the kernel move the bytes where it can
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(copyfile, filesToCopy.keys(), filesToCopy.values()))
 
     numNotesWritten = 0
     for tag, group in noteGroups.items():
         outFileName = "{}/{}.org".format(outputDir, makeSafeFilename(tag))
 
-        notesSortedByDate = sorted(group, key=lambda note: note.date)
+        notesSortedByDate = sorted(group, key=lambda note: note.timestamp)
         # If capture etc. appends, we should probably follow that same logic (don't reverse)
         # notesSortedByDate.reverse()
 
-        # Concatenate all notes into lines
-        lines = []
-        archivedLines = []
+        # Render all notes into in-memory buffers so each file gets written in one go
+        notesBuffer = io.StringIO()
+        archivedBuffer = io.StringIO()
         for note in notesSortedByDate:
-            if note.archived:
-                archivedLines.append(note.toOrgString() + "\n")
-            else:
-                lines.append(note.toOrgString() + "\n")
-
-        if len(archivedLines) and includeArchived:
-            lines = ["* *Archived*\n"] + archivedLines + lines
-
-        outFile = open(outFileName, "w")
-        outFile.writelines(lines)
-        outFile.close()
+            buffer = archivedBuffer if note.archived else notesBuffer
+            buffer.write(note.toOrgString(stripTags=splitByTag))
+            buffer.write("\n")
+
+        with open(outFileName, "w", encoding="utf-8", buffering=1 << 20) as outFile:
+            if archivedBuffer.tell() and includeArchived:
+                outFile.write("* *Archived*\n")
+                outFile.write(archivedBuffer.getvalue())
+            outFile.write(notesBuffer.getvalue())
         print("Wrote {} notes to {}".format(len(group), outFileName))
         numNotesWritten += len(group)
 